@@ -1,18 +1,143 @@
 import os
 import asyncio
-import json
+import inspect
+import orjson
+import time
+import sqlite3
+import hashlib
 from contextlib import AsyncExitStack
-from typing import Any, Dict, List, Optional
-import nest_asyncio
+from typing import Any, Dict, List, Optional, Protocol
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-nest_asyncio.apply()
-
 # Load environment variables from .env file
 load_dotenv()
 
+# How long a list_tools() result is reused before the server is asked again.
+TOOLS_TTL_SECONDS = 60
+
+# --- Answer Cache ---
+# ask() is deterministic for a given database and data dictionary, so final answers
+# are cached by question and invalidated when either file changes.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "data", "electric_vehicle_data.db")
+DATA_DICT_PATH = os.path.join(BASE_DIR, "data", "data_dictionary_v2.csv")
+SERVER_ASSETS_PATH = os.path.join(BASE_DIR, "server_assets.py")
+ANSWER_CACHE_PATH = os.path.join(BASE_DIR, "data", "answer_cache.db")
+
+def _file_mtime_ns(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def _data_dictionary_source() -> str:
+    """The file the server reads the data dictionary from: the baked server_assets.py if present, else the CSV."""
+    return SERVER_ASSETS_PATH if os.path.exists(SERVER_ASSETS_PATH) else DATA_DICT_PATH
+
+def _answer_cache_key(question: str) -> str:
+    data_dict_path = _data_dictionary_source()
+    key_parts = [question, _file_mtime_ns(DB_PATH), data_dict_path, _file_mtime_ns(data_dict_path)]
+    return hashlib.sha256(orjson.dumps(key_parts)).hexdigest()
+
+def _tool_result_dict(result: Any) -> Dict:
+    """
+    Returns a dict-returning tool's result. Uses the MCP structured content directly,
+    falling back to decoding the text content for servers without structured output.
+    """
+    structured = getattr(result, "structuredContent", None)
+    if structured is not None:
+        return structured
+    return orjson.loads(result.content[0].text)
+
+# --- Final Answer Input ---
+# The query result sent to generate_final_answer is capped at FINAL_ANSWER_MAX_ROWS rows
+# and FINAL_ANSWER_MAX_CHARS characters of serialized rows, to keep the prompt small.
+FINAL_ANSWER_MAX_ROWS = 20
+FINAL_ANSWER_MAX_CHARS = 8000
+
+def _bound_query_result(db_dict: Dict) -> Dict:
+    """
+    Limits the query result sent to the LLM to the first rows that fit within
+    FINAL_ANSWER_MAX_ROWS and FINAL_ANSWER_MAX_CHARS (always at least one row),
+    with the total row count so the answer can still mention it.
+    """
+    rows = db_dict.get("rows", [])
+    row_count = len(rows)
+
+    kept_rows = []
+    used_chars = 0
+    for row in rows[:FINAL_ANSWER_MAX_ROWS]:
+        row_chars = len(orjson.dumps(row))
+        if kept_rows and used_chars + row_chars > FINAL_ANSWER_MAX_CHARS:
+            break
+        kept_rows.append(row)
+        used_chars += row_chars
+
+    if len(kept_rows) == row_count:
+        return db_dict
+    print(f" -> Sending {len(kept_rows)} of {row_count} rows to generate_final_answer.")
+    return {
+        "columns": db_dict.get("columns", []),
+        "rows": kept_rows,
+        "total_rows": row_count,
+        "truncated": True,
+    }
+
+# --- Tool Invokers ---
+# ask() talks to the tools through a ToolInvoker, so the same pipeline can run against
+# the MCP server over stdio or call the server's functions directly in this process.
+class ToolInvoker(Protocol):
+    async def call_json(self, name: str, arguments: Dict[str, Any]) -> Dict:
+        """Calls a tool that returns a dict."""
+        ...
+
+    async def call_text(self, name: str, arguments: Dict[str, Any]) -> str:
+        """Calls a tool that returns a string."""
+        ...
+
+class StdioToolInvoker:
+    """Calls tools on an MCP server through a ClientSession."""
+
+    def __init__(self, session: ClientSession):
+        self.session = session
+
+    async def call_json(self, name: str, arguments: Dict[str, Any]) -> Dict:
+        result = await self.session.call_tool(name, arguments)
+        if result.isError:
+            raise RuntimeError(f"Tool {name} failed: {result.content[0].text}")
+        return _tool_result_dict(result)
+
+    async def call_text(self, name: str, arguments: Dict[str, Any]) -> str:
+        result = await self.session.call_tool(name, arguments)
+        if result.isError:
+            raise RuntimeError(f"Tool {name} failed: {result.content[0].text}")
+        return result.content[0].text
+
+class InProcessToolInvoker:
+    """
+    Calls the @mcp.tool() functions from server.py directly, skipping the subprocess
+    and JSON-RPC round-trip. Blocking tools run in a worker thread so concurrent
+    calls (asyncio.gather) still overlap.
+    """
+
+    def __init__(self):
+        import server
+        self.server = server
+
+    async def _call(self, name: str, arguments: Dict[str, Any]) -> Any:
+        tool_fn = getattr(self.server, name)
+        if inspect.iscoroutinefunction(tool_fn):
+            return await tool_fn(**arguments)
+        return await asyncio.to_thread(tool_fn, **arguments)
+
+    async def call_json(self, name: str, arguments: Dict[str, Any]) -> Dict:
+        return await self._call(name, arguments)
+
+    async def call_text(self, name: str, arguments: Dict[str, Any]) -> str:
+        return await self._call(name, arguments)
+
 class SQLAgentClient:
     """Orchestrates a multi-step AI pipeline to answer questions using a database."""
 
@@ -21,10 +146,20 @@ class SQLAgentClient:
         self.exit_stack = AsyncExitStack()
         self.stdio: Optional[Any] = None
         self.write: Optional[Any] = None
+        self.tools: Optional[ToolInvoker] = None
+        self._tools_cache: Optional[List[Any]] = None
+        self._tools_cache_ts: float = 0.0
+        self._answer_cache: Optional[sqlite3.Connection] = None
         print("SQL Agent Client initialized.")
 
     async def connect(self, server_script_path: str = "server.py"):
-        """Connects to the MCP server."""
+        """
+        Connects to the MCP server. The stdio subprocess and session are kept open
+        until disconnect() is called, so a long-running process can reuse them for
+        many ask() calls. Calling connect() while already connected is a no-op.
+        """
+        if self.session:
+            return
         print(f"Connecting to MCP server: {server_script_path}...")
         server_params = StdioServerParameters(command="python", args=[server_script_path])
         try:
@@ -32,43 +167,122 @@ class SQLAgentClient:
             self.stdio, self.write = stdio_transport
             self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
             await self.session.initialize()
+            self.tools = StdioToolInvoker(self.session)
 
-            tools_result = await self.session.list_tools()
+            tools = await self.list_tools()
             print("\nSuccessfully connected. Available tools:")
-            for tool in tools_result.tools:
+            for tool in tools:
                 print(f"  - {tool.name}")
         except Exception as e:
             print(f"Failed to connect: {e}")
+            await self.disconnect()
             raise
 
-    async def ask(self, question: str) -> str:
-        """Processes a question through the full pipeline with a validation/retry loop."""
+    async def list_tools(self) -> List[Any]:
+        """Returns the server's tools, only asking the server again once the cache is older than TOOLS_TTL_SECONDS."""
         if not self.session:
+            raise RuntimeError("Not connected to the server.")
+        now = time.monotonic()
+        if self._tools_cache is None or now - self._tools_cache_ts > TOOLS_TTL_SECONDS:
+            tools_result = await self.session.list_tools()
+            self._tools_cache = tools_result.tools
+            self._tools_cache_ts = now
+        return self._tools_cache
+
+    def _get_answer_cache(self) -> sqlite3.Connection:
+        """Returns the connection to the answer cache database, creating the table on first use."""
+        if self._answer_cache is None:
+            conn = sqlite3.connect(ANSWER_CACHE_PATH)
+            conn.execute("CREATE TABLE IF NOT EXISTS answer_cache (hash TEXT PRIMARY KEY, question TEXT, final_answer TEXT, ts INTEGER)")
+            conn.commit()
+            self._answer_cache = conn
+        return self._answer_cache
+
+    def _get_cached_answer(self, cache_key: str) -> Optional[str]:
+        try:
+            row = self._get_answer_cache().execute(
+                "SELECT final_answer FROM answer_cache WHERE hash = ?", (cache_key,)
+            ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            print(f" -> Answer cache unavailable: {e}")
+            return None
+
+    def _store_answer(self, cache_key: str, question: str, final_answer: str):
+        try:
+            conn = self._get_answer_cache()
+            conn.execute(
+                "INSERT OR REPLACE INTO answer_cache (hash, question, final_answer, ts) VALUES (?, ?, ?, ?)",
+                (cache_key, question, final_answer, int(time.time())),
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f" -> Could not store answer in cache: {e}")
+
+    async def _generate_sql_stepwise(self, question: str) -> Dict:
+        """Runs the original three-call NER -> create_sql -> validator chain and returns the validated SQL dict."""
+        # Step 1: Extract Entities with NER, fetching the schema for Step 3 at the same time
+        print("Step 1: Calling ner_generator_dynamic (and get_schema)...")
+        ner_task = asyncio.create_task(self.tools.call_json("ner_generator_dynamic", {"question": question}))
+        schema_task = asyncio.create_task(self.tools.call_text("get_schema", {}))
+        ner_dict, schema_info = await asyncio.gather(ner_task, schema_task, return_exceptions=True)
+        if isinstance(ner_dict, BaseException):
+            raise ner_dict
+        if isinstance(schema_info, BaseException):
+            # Let the validator read the schema itself rather than passing it an error
+            print(f" -> Could not prefetch schema: {schema_info}")
+            schema_info = ""
+        print(f" -> NER Result: {ner_dict}")
+
+        # Step 2: Create SQL Query
+        print("Step 2: Calling create_sql...")
+        sql_dict = await self.tools.call_json("create_sql", {"question": question, "ner_dict": ner_dict})
+        print(f" -> SQL Created: {sql_dict}")
+
+        # Step 3: Validate SQL Query
+        print("Step 3: Calling validator_sql_agent...")
+        validated_sql_dict = await self.tools.call_json("validator_sql_agent", {
+            "question": question,
+            "ner_dict": ner_dict,
+            "generated_query_dict": sql_dict,
+            "schema_info": schema_info
+        })
+        return validated_sql_dict
+
+    async def ask(self, question: str) -> str:
+        """
+        Processes a question through the full pipeline with a validation/retry loop.
+        Answers are cached per question and reused until the database or data dictionary changes.
+        """
+        cache_key = _answer_cache_key(question)
+        cached_answer = self._get_cached_answer(cache_key)
+        if cached_answer is not None:
+            print(f"\nReturning cached answer for: \"{question}\"")
+            return cached_answer
+
+        if not self.tools:
             return "Error: Not connected to the server."
 
         print(f"\nProcessing question: \"{question}\"")
         try:
-            # Step 1: Extract Entities with NER
-            print("Step 1: Calling ner_generator_dynamic...")
-            ner_result = await self.session.call_tool("ner_generator_dynamic", {"question": question})
-            ner_dict = json.loads(ner_result.content[0].text) 
-            print(f" -> NER Result: {ner_dict}")
-
-            # Step 2: Create SQL Query
-            print("Step 2: Calling create_sql...")
-            sql_result = await self.session.call_tool("create_sql", {"question": question, "ner_dict": ner_dict})
-            sql_dict = json.loads(sql_result.content[0].text) 
-            print(f"SQL output : {sql_result.content[0]}") 
-            print(f" -> SQL Created: {sql_dict}")
-
-            # Step 3: Validate SQL Query
-            print("Step 3: Calling validator_sql_agent...")
-            validated_result = await self.session.call_tool("validator_sql_agent", {
-                "question": question,
-                "ner_dict": ner_dict,
-                "generated_query_dict": sql_dict
-            })
-            validated_sql_dict = json.loads(validated_result.content[0].text)
+            # Steps 1-3: Extract entities, create and validate SQL in a single LLM call
+            print("Steps 1-3: Calling ner_sql_validate_combined...")
+            combined_dict = await self.tools.call_json("ner_sql_validate_combined", {"question": question})
+            print(f" -> Combined Result: {combined_dict}")
+
+            if "error" in combined_dict or not combined_dict.get("sql_query"):
+                # Fall back to the separate NER -> create -> validate tools
+                print(" -> Combined step failed, falling back to the step-by-step pipeline.")
+                validated_sql_dict = await self._generate_sql_stepwise(question)
+            else:
+                # Check the SQL locally before running it (no LLM call unless the check fails):
+                # SQLite would otherwise run a misspelled "quoted" column as a string literal.
+                print("Step 3: Calling validator_sql_agent on the combined SQL...")
+                validated_sql_dict = await self.tools.call_json("validator_sql_agent", {
+                    "question": question,
+                    "ner_dict": combined_dict.get("ner") or {},
+                    "generated_query_dict": {"sql_query": combined_dict["sql_query"]}
+                })
             print(f" -> Validated SQL: {validated_sql_dict}")
             
             # --- Retry Loop ---
@@ -76,8 +290,7 @@ class SQLAgentClient:
             for i in range(max_retries):
                 # Step 4: Run Query on Database
                 print(f"Step 4 (Attempt {i+1}/{max_retries}): Calling run_sqlite_query...")
-                db_result = await self.session.call_tool("run_sqlite_query", {"sql_dict": validated_sql_dict})
-                db_dict = json.loads(db_result.content[0].text)  
+                db_dict = await self.tools.call_json("run_sqlite_query", {"sql_dict": validated_sql_dict})
                 print(f" -> Database Result: {db_dict}")
                 
 
@@ -86,11 +299,16 @@ class SQLAgentClient:
                     print(" -> Database query executed successfully.")
                     # Step 6: Generate Final Answer
                     print("Step 6: Calling generate_final_answer...")
-                    final_answer = await self.session.call_tool("generate_final_answer", {
+                    bounded_result = _bound_query_result(db_dict)
+                    final_answer_text = await self.tools.call_text("generate_final_answer", {
                         "question": question, 
-                        "query_result_dict": db_dict
+                        "query_result_dict": bounded_result
                     })
-                    return final_answer.content[0].text
+                    # Don't cache failures reported by the tool itself, or answers built from
+                    # truncated results, which may depend on rows the LLM never saw
+                    if not final_answer_text.startswith("Error formulating final answer") and not bounded_result.get("truncated"):
+                        self._store_answer(cache_key, question, final_answer_text)
+                    return final_answer_text
                 
                 # If there was an error, proceed to the error handler
                 error_message = db_dict.get("error", "Unknown database error")
@@ -98,12 +316,11 @@ class SQLAgentClient:
                 
                 # Step 5: Handle Error
                 print("Step 5: Calling handle_error_agent to fix the query...")
-                error_handler_result = await self.session.call_tool("handle_error_agent", {
+                validated_sql_dict = await self.tools.call_json("handle_error_agent", {
                     "failed_sql_query_dict": validated_sql_dict,
                     "error_message": error_message
                 })
-                # Update the query with the fixed version for the next loop attempt
-                validated_sql_dict = json.loads(error_handler_result.content[0].text)
+                # The query is updated with the fixed version for the next loop attempt
                 print(f" -> Received new query from error handler: {validated_sql_dict}")
 
             return f"Failed to execute the query after {max_retries} attempts. Last error: {db_dict.get('error')}"
@@ -111,15 +328,53 @@ class SQLAgentClient:
         except Exception as e:
             return f"A critical error occurred in the pipeline: {e}"
 
+    async def disconnect(self):
+        """Closes the session and stops the server subprocess. The tools cache is kept for the next connect()."""
+        await self.exit_stack.aclose()
+        self.exit_stack = AsyncExitStack()
+        if self._answer_cache is not None:
+            self._answer_cache.close()
+            self._answer_cache = None
+        self.session = None
+        self.tools = None
+        self.stdio = None
+        self.write = None
+
     async def cleanup(self):
         """Closes the connection."""
         print("\nCleaning up and closing connection...")
-        await self.exit_stack.aclose()
+        await self.disconnect()
         print("Connection closed.")
 
+class InProcessSQLAgentClient(SQLAgentClient):
+    """
+    Runs the same pipeline as SQLAgentClient, but imports server.py and calls its
+    tools directly instead of spawning the MCP server over stdio. Useful when the
+    client and server run on the same machine.
+    """
+
+    async def connect(self, server_script_path: str = "server.py"):
+        """Loads the server module in this process. Calling connect() again is a no-op."""
+        if self.tools:
+            return
+        self.tools = InProcessToolInvoker()
+        tools = await self.list_tools()
+        print("\nLoaded server in process. Available tools:")
+        for tool in tools:
+            print(f"  - {tool.name}")
+
+    async def list_tools(self) -> List[Any]:
+        """Returns the tools registered on the in-process FastMCP server."""
+        if not self.tools:
+            raise RuntimeError("Not connected to the server.")
+        if self._tools_cache is None:
+            self._tools_cache = await self.tools.server.mcp.list_tools()
+        return self._tools_cache
+
 async def main():
     """Main function to run the client."""
-    client = SQLAgentClient()
+    # Set SQL_AGENT_IN_PROCESS=1 to call the server's tools directly instead of over stdio
+    client = InProcessSQLAgentClient() if os.getenv("SQL_AGENT_IN_PROCESS") else SQLAgentClient()
     try:
         await client.connect()
         
@@ -141,4 +396,10 @@ async def main():
         await client.cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # uvloop is an optional, faster event loop; fall back to the default one without it
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
\ No newline at end of file
@@ -0,0 +1,32 @@
+import csv
+from typing import Dict, List
+
+def build_data_dictionary_description(csv_path: str) -> str:
+    """
+    Reads the data dictionary CSV and formats it into a string, grouped by table,
+    to provide clear context to the AI about the entire database schema.
+    Raises KeyError if the required 'Table Name' column is missing.
+    """
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        # Check if the required 'Table Name' column exists
+        if 'Table Name' not in (reader.fieldnames or []):
+            raise KeyError("Table Name")
+        rows = list(reader)
+
+    # Group the rows by the 'Table Name' (sorted, as pandas' groupby did)
+    tables: Dict[str, List[Dict[str, str]]] = {}
+    for row in rows:
+        tables.setdefault(row['Table Name'], []).append(row)
+
+    # Collect the pieces and join once instead of growing a string in a loop
+    parts = ["This is the data dictionary. It explains the columns for multiple tables in the database:\n"]
+    for table_name in sorted(tables):
+        parts.append(f"\n--- Table: {table_name} ---\n")
+        # Each row describes one column of the current table
+        parts.extend(
+            f"- Column '{row['Column Header']}' (also called '{row['Business Header']}'): {row['Definition']}. Example: {row['Example']}\n"
+            for row in tables[table_name]
+        )
+
+    return "".join(parts)
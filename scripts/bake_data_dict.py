@@ -0,0 +1,30 @@
+"""
+Bakes the formatted data dictionary into server_assets.py so the server can import
+it as a constant instead of reading the CSV at runtime. Run this at deploy time,
+and again whenever the data dictionary CSV changes:
+
+    python scripts/bake_data_dict.py [csv_path] [output_path]
+"""
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from data_dictionary import build_data_dictionary_description
+
+DEFAULT_CSV_PATH = os.path.join(BASE_DIR, "data", "data_dictionary_v2.csv")
+DEFAULT_OUTPUT_PATH = os.path.join(BASE_DIR, "server_assets.py")
+
+def main():
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CSV_PATH
+    output_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT_PATH
+
+    description = build_data_dictionary_description(csv_path)
+    with open(output_path, "w") as f:
+        f.write(f"# Generated by scripts/bake_data_dict.py from {os.path.basename(csv_path)}. Do not edit.\n")
+        f.write(f"DATA_DICTIONARY_DESCRIPTION = {description!r}\n")
+    print(f"Wrote {output_path} ({len(description)} characters).")
+
+if __name__ == "__main__":
+    main()
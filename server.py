@@ -1,11 +1,28 @@
 import os
+import asyncio
 import json
+import orjson
 import sqlite3
+import functools
+import collections
+import threading
+import time
+import hashlib
+import urllib.parse
 from mcp.server.fastmcp import FastMCP
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+import httpx
 from dotenv import load_dotenv
-import pandas as pd
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
+from data_dictionary import build_data_dictionary_description
+from sql_check import find_unknown_identifiers
+
+# The data dictionary is baked into server_assets.py at deploy time (scripts/bake_data_dict.py).
+# Without it, the server falls back to reading the CSV on first use.
+try:
+    from server_assets import DATA_DICTIONARY_DESCRIPTION
+except ImportError:
+    DATA_DICTIONARY_DESCRIPTION = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,8 +33,20 @@ mcp = FastMCP(
 )
 
 # Initialize the Anthropic client
-anthropic_client = Anthropic(
-    api_key=os.getenv("ANTHROPIC_API_KEY"),)
+# All tools share one async client whose HTTP connection pool keeps connections
+# alive between calls, so concurrent requests skip repeated TCP/TLS handshakes.
+anthropic_client = AsyncAnthropic(
+    api_key=os.getenv("ANTHROPIC_API_KEY"),
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    ),
+)
+
+# Beta header that enables prompt caching (cache_control) on older API versions.
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+
+# Bounds the number of in-flight Anthropic requests to stay clear of rate limits.
+_LLM_SEM = asyncio.Semaphore(20)
 
 # --- Absolute Paths for Data Files ---
 # This ensures the server can find the files regardless of how it's started.
@@ -25,30 +54,254 @@ BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(BASE_DIR, "data", "electric_vehicle_data.db")
 DATA_DICT_PATH = os.path.join(BASE_DIR, "data", "data_dictionary_v2.csv")
 
+# --- Shared SQLite Connection ---
+# One read-only connection is opened lazily and reused for every query instead of
+# reconnecting per call. sqlite3 connections are not safe for concurrent use, hence the lock.
+# The database is never written by this agent, so the connection is opened with
+# mode=ro&immutable=1: no WAL/lock files, and any write attempt fails cleanly.
+_CONN: Optional[sqlite3.Connection] = None
+_CONN_MTIME: Optional[int] = None
+_CONN_LOCK = threading.Lock()
+
+# Write-side settings (journal_mode, synchronous, busy_timeout) do not apply to an
+# immutable read-only connection, so only the read-side tuning is kept.
+_SQLITE_PRAGMAS = (
+    "PRAGMA cache_size=-64000;",
+    "PRAGMA temp_store=memory;",
+    "PRAGMA mmap_size=268435456;",
+)
+
+def _connect_read_only(db_path: str) -> sqlite3.Connection:
+    """Opens db_path read-only and immutable using a SQLite URI."""
+    uri = f"file:{urllib.parse.quote(db_path)}?mode=ro&immutable=1"
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+def _get_connection() -> sqlite3.Connection:
+    """
+    Returns the shared, PRAGMA-tuned connection to DB_PATH. Callers must hold _CONN_LOCK.
+    Since immutable=1 lets SQLite assume the file never changes, the connection is
+    reopened if the file's mtime moves (e.g. the database was rebuilt).
+    """
+    global _CONN, _CONN_MTIME
+    mtime = os.stat(DB_PATH).st_mtime_ns
+    if _CONN is not None and _CONN_MTIME != mtime:
+        _CONN.close()
+        _CONN = None
+    if _CONN is None:
+        conn = _connect_read_only(DB_PATH)
+        for pragma in _SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _CONN = conn
+        _CONN_MTIME = mtime
+    return _CONN
+
+# orjson has no raw_decode, so the stdlib decoder is kept for pulling JSON out of prose
+_JSON_DECODER = json.JSONDecoder()
+
+# --- LLM Response Cache ---
+# Every tool's prompt is fully determined by its inputs, so identical prompts can reuse
+# an earlier response. Responses are kept in a small local SQLite table keyed by the
+# SHA-256 of (model, max_tokens, prompt) and expire after LLM_CACHE_TTL_SECONDS.
+LLM_CACHE_PATH = os.path.join(BASE_DIR, "data", "llm_cache.db")
+LLM_CACHE_TTL_SECONDS = 24 * 60 * 60
+_LLM_CACHE_CONN: Optional[sqlite3.Connection] = None
+_LLM_CACHE_LOCK = threading.Lock()
+
+def _get_llm_cache() -> sqlite3.Connection:
+    """Returns the connection to the LLM cache database, creating the table on first use. Callers must hold _LLM_CACHE_LOCK."""
+    global _LLM_CACHE_CONN
+    if _LLM_CACHE_CONN is None:
+        conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (hash TEXT PRIMARY KEY, response TEXT, ts INTEGER)")
+        conn.commit()
+        _LLM_CACHE_CONN = conn
+    return _LLM_CACHE_CONN
+
+def _llm_cache_key(model: str, max_tokens: int, prompt: str, *extra: str) -> str:
+    return hashlib.sha256(orjson.dumps([model, max_tokens, prompt, *extra])).hexdigest()
+
+def _llm_cache_get(key: str) -> Optional[str]:
+    try:
+        with _LLM_CACHE_LOCK:
+            row = _get_llm_cache().execute(
+                "SELECT response FROM llm_cache WHERE hash = ? AND ts >= ?",
+                (key, int(time.time()) - LLM_CACHE_TTL_SECONDS),
+            ).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        # A broken cache must never break the pipeline; treat it as a miss.
+        return None
+
+def _llm_cache_put(key: str, response: str) -> None:
+    try:
+        with _LLM_CACHE_LOCK:
+            conn = _get_llm_cache()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (hash, response, ts) VALUES (?, ?, ?)",
+                (key, response, int(time.time())),
+            )
+            conn.commit()
+    except sqlite3.Error:
+        pass
+
+# Cache policies for _create_message / _create_structured_message.
+# Generated SQL is only worth replaying once it is known to run: it is held back in
+# _PENDING_SQL_CACHE until run_sqlite_query succeeds with it, and dropped if it fails.
+CACHE_ALWAYS = "always"
+CACHE_NEVER = "never"
+CACHE_AFTER_SQL_RUNS = "after_sql_runs"
+_PENDING_SQL_CACHE_MAX = 256
+_PENDING_SQL_CACHE: "collections.OrderedDict[str, List[Tuple[str, str]]]" = collections.OrderedDict()
+_PENDING_SQL_CACHE_LOCK = threading.Lock()
+
+def _llm_cache_store(key: str, response: str, cache_policy: str, sql_query: Optional[str]) -> None:
+    """Stores a response according to cache_policy; see CACHE_AFTER_SQL_RUNS."""
+    if cache_policy == CACHE_ALWAYS:
+        _llm_cache_put(key, response)
+    elif cache_policy == CACHE_AFTER_SQL_RUNS and sql_query:
+        with _PENDING_SQL_CACHE_LOCK:
+            _PENDING_SQL_CACHE.setdefault(sql_query, []).append((key, response))
+            _PENDING_SQL_CACHE.move_to_end(sql_query)
+            while len(_PENDING_SQL_CACHE) > _PENDING_SQL_CACHE_MAX:
+                _PENDING_SQL_CACHE.popitem(last=False)
+
+def _settle_pending_sql_cache(sql_query: str, succeeded: bool) -> None:
+    """Called after sql_query runs: caches the responses that produced it on success, drops them on failure."""
+    with _PENDING_SQL_CACHE_LOCK:
+        pending = _PENDING_SQL_CACHE.pop(sql_query, [])
+    if succeeded:
+        for key, response in pending:
+            _llm_cache_put(key, response)
+
+def _message_kwargs(model: str, max_tokens: int, prompt: str, system: str) -> Dict[str, Any]:
+    """Builds the messages API arguments shared by _create_message and _create_structured_message."""
+    kwargs: Dict[str, Any] = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    if system:
+        # The system text is the same on every call for a tool, so mark it for Anthropic's
+        # prompt cache: repeat calls within ~5 minutes reuse it instead of re-processing it.
+        kwargs["system"] = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+        kwargs["extra_headers"] = {"anthropic-beta": PROMPT_CACHING_BETA}
+    return kwargs
+
+async def _create_message(model: str, max_tokens: int, prompt: str, system: str = "", cache_policy: str = CACHE_ALWAYS) -> str:
+    """
+    Sends a single-turn prompt to Claude and returns the response text.
+    Static context that is the same for every call (instructions, schema, data dictionary)
+    goes in system, so only the question-specific part changes in prompt.
+    Responses are served from the local cache when the same prompt was answered recently.
+    The response is streamed and accumulated as it arrives.
+    With CACHE_AFTER_SQL_RUNS the response text is taken to be the SQL query itself.
+    """
+    key = _llm_cache_key(model, max_tokens, prompt, system)
+    cached = _llm_cache_get(key) if cache_policy != CACHE_NEVER else None
+    if cached is not None:
+        return cached
+
+    buffer = ""
+    async with _LLM_SEM:
+        async with anthropic_client.messages.stream(**_message_kwargs(model, max_tokens, prompt, system)) as stream:
+            async for text_chunk in stream.text_stream:
+                buffer += text_chunk
+    _llm_cache_store(key, buffer, cache_policy, buffer)
+    return buffer
+
+async def _create_structured_message(model: str, max_tokens: int, prompt: str, tool_name: str, input_schema: Dict, system: str = "", cache_policy: str = CACHE_ALWAYS) -> Dict:
+    """
+    Sends a single-turn prompt to Claude and forces it to answer by calling the
+    tool_name tool, so the reply arrives as an already-parsed dict matching
+    input_schema instead of JSON embedded in prose. Cached like _create_message;
+    with CACHE_AFTER_SQL_RUNS the SQL is read from the result's "sql_query" key.
+    """
+    key = _llm_cache_key(model, max_tokens, prompt, system, tool_name, orjson.dumps(input_schema, option=orjson.OPT_SORT_KEYS).decode())
+    cached = _llm_cache_get(key) if cache_policy != CACHE_NEVER else None
+    if cached is not None:
+        return orjson.loads(cached)
+
+    async with _LLM_SEM:
+        async with anthropic_client.messages.stream(
+            **_message_kwargs(model, max_tokens, prompt, system),
+            tools=[{"name": tool_name, "description": "Return the result as structured data.", "input_schema": input_schema}],
+            tool_choice={"type": "tool", "name": tool_name},
+        ) as stream:
+            message = await stream.get_final_message()
+
+    for block in message.content:
+        if block.type == "tool_use":
+            result = dict(block.input)
+            break
+    else:
+        # Should not happen with a forced tool choice; fall back to parsing any text
+        text = "".join(block.text for block in message.content if block.type == "text")
+        result = _parse_llm_json_response(text)
+        if "error" in result:
+            return result
+
+    # A tool call cut off at max_tokens can still parse, but as a partial (or empty) dict.
+    # Report it as an error and keep it out of the cache.
+    if message.stop_reason == "max_tokens":
+        return {"error": f"Response from {tool_name} was cut off at max_tokens={max_tokens}."}
+    missing = [name for name in input_schema.get("required", []) if name not in result]
+    if missing:
+        return {"error": f"Response from {tool_name} is missing required keys: {', '.join(missing)}."}
+
+    _llm_cache_store(key, orjson.dumps(result).decode(), cache_policy, result.get("sql_query"))
+    return result
+
+# --- Output Schemas for Structured Responses ---
+_NER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "table": {
+            "anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}],
+            "description": "The county table name(s), e.g. \"King\".",
+        },
+        "columns_to_select": {"type": "array", "items": {"type": "string"}},
+        "filters": {"type": "object", "description": "Column name -> condition."},
+    },
+    "required": ["table", "columns_to_select", "filters"],
+}
+
+_SQL_QUERY_SCHEMA = {
+    "type": "object",
+    "properties": {"sql_query": {"type": "string", "description": "A single SQLite query."}},
+    "required": ["sql_query"],
+}
+
+_COMBINED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ner": _NER_SCHEMA,
+        "sql_query": {"type": "string", "description": "The final, validated SQLite query."},
+        "validation_notes": {"type": "string"},
+    },
+    "required": ["ner", "sql_query", "validation_notes"],
+}
+
 # --- Helper Function ---
+@functools.lru_cache(maxsize=1)
+def _load_data_dictionary_description() -> str:
+    """
+    Builds the data dictionary description once per server lifetime; the CSV does
+    not change while the server is running. Errors are raised (and so not cached).
+    """
+    return build_data_dictionary_description(DATA_DICT_PATH)
+
 def get_data_dictionary_description():
     """
-    Reads the data dictionary CSV and formats it into a string, grouped by table,
-    to provide clear context to the AI about the entire database schema.
+    Returns the data dictionary formatted as a string, grouped by table, to provide
+    clear context to the AI about the entire database schema. Uses the constant
+    baked into server_assets.py when available, otherwise reads the CSV once.
     """
+    if DATA_DICTIONARY_DESCRIPTION is not None:
+        return DATA_DICTIONARY_DESCRIPTION
     try:
-        df = pd.read_csv(DATA_DICT_PATH)
-       
-        # Check if the required 'Table Name' column exists
-        if 'Table Name' not in df.columns:
-            return "Error: The data dictionary CSV is missing the required 'Table Name' column."
-
-        description = "This is the data dictionary. It explains the columns for multiple tables in the database:\n"
-       
-        # Group the dataframe by the 'Table Name'
-        for table_name, group in df.groupby('Table Name'):
-            description += f"\n--- Table: {table_name} ---\n"
-            # Iterate over each row in the group (i.e., each column for the current table)
-            for _, row in group.iterrows():
-                description += f"- Column '{row['Column Header']}' (also called '{row['Business Header']}'): {row['Definition']}. Example: {row['Example']}\n"
-       
-        return description
-       
+        return _load_data_dictionary_description()
+    except KeyError:
+        return "Error: The data dictionary CSV is missing the required 'Table Name' column."
     except FileNotFoundError:
         return "Data dictionary file not found. I will proceed without it."
     except Exception as e:
@@ -57,103 +310,107 @@ def get_data_dictionary_description():
 def _parse_llm_json_response(llm_text_response: str) -> Dict:
     """
     A robust helper function to extract a JSON object from an LLM text response.
+    Decodes the first JSON object starting at the first '{', ignoring any trailing prose.
     """
+    start_index = llm_text_response.find("{")
+    if start_index == -1:
+        return {"error": "No valid JSON found in the response."}
     try:
-        #find the start and end of the JSON object
-        start_index = llm_text_response.find("{")
-        end_index = llm_text_response.rfind("}") + 1
-        if start_index != -1 and end_index != 0:
-            json_str = llm_text_response[start_index:end_index]
-            # Parse the JSON string to ensure it's valid
-            return json.loads(json_str)
+        parsed, _ = _JSON_DECODER.raw_decode(llm_text_response, start_index)
     except json.JSONDecodeError as e:
         return {"error": f"JSON decoding error: {e}"}
-    return {"error": "No valid JSON found in the response."}
+    if not isinstance(parsed, dict):
+        return {"error": "No valid JSON found in the response."}
+    return parsed
+
+# Schema descriptions and identifier sets keyed by (db_path, mtime_ns); a changed file gets a new key.
+_SCHEMA_CACHE: Dict[tuple, Tuple[str, frozenset]] = {}
+
+def _load_schema(db_path) -> Tuple[str, frozenset]:
+    """
+    Returns (schema description, lower-cased table and column names) for db_path,
+    read once per version of the file.
+    """
+    # Reuse the cached schema while the database file is unchanged
+    mtime = os.stat(db_path).st_mtime_ns
+    cache_key = (db_path, mtime)
+    if cache_key in _SCHEMA_CACHE:
+        return _SCHEMA_CACHE[cache_key]
+
+    with _CONN_LOCK:
+        # Use the shared connection for the main database, a throwaway one otherwise
+        conn = _get_connection() if db_path == DB_PATH else _connect_read_only(db_path)
+        try:
+            cursor = conn.cursor()
+
+            #give a list of all tables in the database
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+            tables = cursor.fetchall()
+            table_names = [table[0] for table in tables]
+            identifiers = {name.lower() for name in table_names}
+            str_table_names = ", ".join(table_names)
+            str_table_names = str_table_names.replace(" ", "")
+
+            schema_description = f"Database schema contains the following tables: {str_table_names}. Each table contains various columns with specific data types."
+            for table_name in table_names:
+                # Get the column names and types for each table
+                schema_description += f"\n\nTable: {table_name}\nColumns:\n"
+                cursor.execute(f"PRAGMA table_info({table_name});")
+                columns = cursor.fetchall()
+                for col in columns:
+                    column_name = col[1]
+                    column_type = col[2]
+                    identifiers.add(column_name.lower())
+                    schema_description += f"{column_name} ({column_type})\n"
+        finally:
+            if conn is not _CONN:
+                conn.close()
+    # Drop entries for older versions of this file, then cache and return the schema
+    for key in [k for k in _SCHEMA_CACHE if k[0] == db_path]:
+        del _SCHEMA_CACHE[key]
+    _SCHEMA_CACHE[cache_key] = (schema_description, frozenset(identifiers))
+    return _SCHEMA_CACHE[cache_key]
 
 def get_database_schema(db_path):
+    return _load_schema(db_path)[0]
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    #give a list of all tables in the database
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    table_names = [table[0] for table in tables]
-    str_table_names = ", ".join(table_names)
-    str_table_names = str_table_names.replace(" ", "")
-
-    schema_description = f"Database schema contains the following tables: {str_table_names}. Each table contains various columns with specific data types."
-    for table_name in table_names:
-        # Get the column names and types for each table
-        schema_description += f"\n\nTable: {table_name}\nColumns:\n"
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        for col in columns:
-            column_name = col[1]
-            column_type = col[2]
-            schema_description += f"{column_name} ({column_type})\n"
-    # Close the database connection
-    conn.close()
-    # Return the schema description
-    return schema_description
 # --- Tool 1: NER Generator ---
 @mcp.tool()
-def ner_generator_dynamic(question: str) -> str: #returns a JSON string
+async def ner_generator_dynamic(question: str) -> Dict[str, Any]: #returns a dict, sent as MCP structured content
     """
     Analyzes a question to extract key entities (tables, columns, filters)
     needed to form a database query. Uses a data dictionary for context.
     """
     data_dictionary = get_data_dictionary_description()
-    prompt = f"""
+    system = f"""
     You are a data analyst. Your job is to extract key entities from a user's question.
-    Use the provided data dictionary to understand the columns.
+    Use the provided data dictionary to understand the columns and tables. It provides the structure and meaning of the database tables and columns.
     Get the correct table name, columns to select, and any filters needed.
-    The data dictionary provides the structure and meaning of the database tables and columns.
     For example, if you thought 'Electric_Range' but the Data Dictionary says 'Electric Range', you must correct it to '"Electric Range"'
-    Use the provided data dictionary to understand the columns and tables. ** The user might mention multiple tables (counties). **
-
-
-    Data Dictionary:
-    {data_dictionary}
+    ** The user might mention multiple tables (counties). It's okay if the question involves multiple tables. **
 
-    User Question: "{question}"
-
-    Extract the necessary components to answer the question. It's okay if the question involves multiple tables. Your output MUST be a single JSON object with keys: "table", "columns_to_select", and "filters".
+    Your output MUST be a single JSON object with keys: "table", "columns_to_select", and "filters".
     - "table": The table name, which is always a county name (e.g., "King").
     - "columns_to_select": A list of columns the user wants to see.
     - "filters": A dictionary of filters to apply, where the key is the column name and value is the condition.
 
+    Data Dictionary:
+    {data_dictionary}
     """
+    prompt = f'User Question: "{question}"\nExtract the necessary components to answer the question.'
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1024,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        json_str = response.content[0].text
-        parsed_dict = _parse_llm_json_response(json_str)
-        return json.dumps(parsed_dict)
+        parsed_dict = await _create_structured_message("claude-3-5-sonnet-20241022", 1024, prompt, "emit_ner", _NER_SCHEMA, system=system)
+        return parsed_dict
         
     except Exception as e:
-        return json.dumps({"error": f"Error in ner_generator_dynamic: {e}"})
+        return {"error": f"Error in ner_generator_dynamic: {e}"}
     
 # --- Tool 2: Create SQL ---
-@mcp.tool()
-def create_sql(question: str, ner_dict: Dict) -> str:#returns a JSON string
-    """
-    Creates a full SQLite query by combining the user's question and the
-    extracted entities from the ner_generator_dynamic tool.
-    """
-    ner_json = json.dumps(ner_dict, indent=2)
-    prompt = f"""
+_CREATE_SQL_SYSTEM_PROMPT = """
     You are an expert SQLite developer. Create a single, valid SQLite query to answer the user's question.
     Understand the user's intent and the context provided by the extracted entities.
     The query may be complex, using window functions (like ROW_NUMBER(), PARTITION BY), subqueries, or other advanced features.
 
-    User's Question: "{question}"
-    Extracted Entities: {ner_json}
-
      *** IMPORTANT INSTRUCTIONS FOR MULTI-TABLE QUERIES *** 
      - The user's database has a separate table for each county (e.g., 'King', 'Thurston', 'Clark'). 
      - All these tables have the exact same columns (e.g., "Make", "Base MSRP", etc.). 
@@ -163,82 +420,148 @@ def create_sql(question: str, ner_dict: Dict) -> str:#returns a JSON string
      Example Task: "Find makes in both Thurston and Clark." 
      Example Correct Query: SELECT T1."Make" FROM Thurston AS T1 INNER JOIN Clark AS T2 ON T1."Make" = T2."Make";
 
-
     Your output MUST be the raw SQLite query text, and nothing else. Do not wrap it in JSON or markdown.
+    """
 
+@mcp.tool()
+async def create_sql(question: str, ner_dict: Dict) -> Dict[str, Any]: #returns a dict, sent as MCP structured content
     """
+    Creates a full SQLite query by combining the user's question and the
+    extracted entities from the ner_generator_dynamic tool.
+    """
+    ner_json = orjson.dumps(ner_dict).decode()
+    prompt = f"""User's Question: "{question}"\nExtracted Entities: {ner_json}"""
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1024,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        
         # The raw SQL query is extracted from the response.
-        raw_sql_query = response.content[0].text
+        raw_sql_query = await _create_message("claude-3-5-sonnet-20241022", 1024, prompt, system=_CREATE_SQL_SYSTEM_PROMPT, cache_policy=CACHE_AFTER_SQL_RUNS)
 
-        # We now reliably create the JSON object in Python.
+        # We now reliably create the result dict in Python.
         sql_dict = {"sql_query": raw_sql_query}
         
-        return json.dumps(sql_dict)
+        return sql_dict
     except Exception as e:
-        return json.dumps({"error": f"LLM Error in create_sql: {e}"})
+        return {"error": f"LLM Error in create_sql: {e}"}
+
+
+
+def _explain_sql_query(sql_query: str) -> Optional[str]:
+    """
+    Checks a query locally without executing it. EXPLAIN on the read-only connection
+    catches syntax errors and unknown unquoted names; double-quoted names are then
+    compared against the schema's tables and columns. Returns an error message for
+    the fixer, or None if the query is valid.
+    """
+    try:
+        with _CONN_LOCK:
+            _get_connection().execute("EXPLAIN " + sql_query).fetchall()
+        unknown = find_unknown_identifiers(sql_query, _load_schema(DB_PATH)[1])
+    except (sqlite3.Error, OSError) as e:
+        return str(e)
+    if unknown:
+        names = ", ".join(f'"{name}"' for name in unknown)
+        return f"no such table or column: {names} (SQLite would treat these as string literals)"
+    return None
+
+async def _fix_sql_query(failed_sql_query: str, error_message: str, schema_info: str, question: str = "") -> Dict[str, Any]:
+    """
+    Asks the LLM to correct a query that SQLite rejected, given the actual error
+    message and the schema. Shared by validator_sql_agent and handle_error_agent.
+    Never cached, so each retry gets a fresh attempt.
+    """
+    system = f"""
+    You are a highly skilled SQLite expert debugging a query.
 
+    Task:
+    1.  Carefully analyze the query and the error message.
+    2.  Every column and table name must exactly match a name in the Official Schema. Column names with spaces must be
+        enclosed in double quotes (e.g., "Electric Range", "Base MSRP", "VIN (1-10)").
+    3.  Provide a corrected SQLite query that resolves the identified error.
 
+    Your output MUST be a single JSON object with one key: "sql_query", containing only the corrected query.
+
+    *** Official Database Schema: ***
+    {schema_info}
+    """
+    question_info = f'The query was written to answer this question: "{question}"\n' if question else ""
+    prompt = f"""{question_info}The following SQL query failed:
+```sql
+{failed_sql_query}
+```
+It produced this specific error message: `{error_message}`"""
+    return await _create_structured_message("claude-3-5-sonnet-20241022", 1024, prompt, "emit_sql_query", _SQL_QUERY_SCHEMA, system=system, cache_policy=CACHE_NEVER)
 
 # --- Tool 3 : Validate SQL agent ---    
 @mcp.tool()
-def validator_sql_agent(question: str, ner_dict: Dict, generated_query_dict: Dict) -> str: #return a JSON string
+async def validator_sql_agent(question: str, ner_dict: Dict, generated_query_dict: Dict, schema_info: str = "") -> Dict[str, Any]: #returns a dict, sent as MCP structured content
     """
-    Validates a generated SQL query for correctness, syntax, and hallucinations against the schema.
-    Returns a corrected/validated version as a JSON string.
-    """
-    schema_info = get_database_schema(DB_PATH)
-    generated_query_json = json.dumps(generated_query_dict) #here it converts the dict to a JSON string
-    data_dictionary_info = get_data_dictionary_description()
-    prompt = f"""
-    You are an extreamely meticulous SQL validator and debugger. Your task is to check if the provided SQL query correctly answers the user's question and is syntactically correct for SQLite.
-    You MUST Strictly follow the schema information provided to ensure no incorrect column or table names. Pay close attention to space or special characters in names. Column names with spaces must be enclosed in double quotes (e.g., "Electric Range").
-    Avoid hallucinations or incorrect names.
-
-    Provided Information:
-    1.  User's Original Question: "{question}"
-    2.  Extracted Entities (for context): {json.dumps(ner_dict, indent=2)}
-    3.  Generated SQL Query to Validate: {generated_query_json}
-    4.  *** Official Database Schema: *** 
-        {schema_info}
-    5.  *** Data Dictionary: *** (for examples of values)
-        {data_dictionary_info}
-
-    Your Two Mandatory Tasks: 
-    1. **Correct Column Names:** First, verify that every single column and table name in the query (in SELECT, WHERE, GROUP BY, etc.) exactly matches a name in the Official Schema. If you see a simplified name like `Make` or `Fuel_Type`, you MUST correct it to the full, quoted name like `"Make"` or `"Electric Vehicle Type"`. 
-    2. **Correct Column Values:** Second, for any columns being filtered in the WHERE clause (like "Electric Vehicle Type"), you MUST ensure the values being compared match the examples in the Data Dictionary. For example, if the query says `... = 'BEV'`, you MUST correct it to `... = 'Battery Electric Vehicle (BEV)'`.
-
-    Your Important Tasks to follow:
-    1. *** CRITICAL VALIDATION: *** Go through every column in the SELECT, WHERE, GROUP BY, and ORDER BY clauses of the generated query. Compare each one against the column names listed in the Official Database Schema.
-    2. If a column name like `VIN` or `MSRP` is used, but the schema specifies `"VIN (1-10)"` or `"Base MSRP"`, you MUST replace it with the correct, fully quoted name from the schema. There are no exceptions.
-    3. Correct any incorrect column/table names using the Official Schema. Remember to quote names with spaces (e.g., "Electric Vehicle Type")
-    4. *** CRITICAL LOGIC CHECK: *** For categorical columns like "Electric Vehicle Type", the WHERE clause must use the full value found in the data dictionary examples (e.g., 'Battery Electric Vehicle (BEV)'), not just an acronym (e.g., 'BEV'). Check the generated query and correct it if necessary.
-    5.  Check for "hallucinated" or incorrect column and table names by comparing against the official schema. For example, if you see 'Electric_Range' but the schema says 'Electric Range', you must correct it to '"Electric Range"'
-    6.  Ensure the query logic accurately reflects the user's question (e.g., if they ask for "top 3", there should be an ORDER BY and LIMIT 3).
-
- 
-    
-    Your output MUST be a single JSON object with one key: "sql_query", containing the final, validated, and potentially corrected query.
+    Validates a generated SQL query for syntax and hallucinated names against the schema.
+    The query is checked locally (EXPLAIN plus a check of quoted names against the schema) and
+    returned unchanged if it passes; only a rejected query is sent to the LLM, with the error, to be corrected.
+    Filter values are not checked against the data dictionary here.
+    If the caller already fetched the schema (via get_schema) it can pass it in as schema_info.
+    ner_dict is accepted for compatibility with existing callers.
     """
+    sql_query = generated_query_dict.get("sql_query")
+    if not sql_query:
+        return {"error": "No SQL query provided."}
+
+    error_message = _explain_sql_query(sql_query)
+    if error_message is None:
+        return {"sql_query": sql_query}
+
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022", max_tokens=1024, messages=[{"role": "user", "content": prompt}]
-        )
-        parsed_dict = _parse_llm_json_response(response.content[0].text)
-        return json.dumps(parsed_dict)
+        if not schema_info:
+            schema_info = get_database_schema(DB_PATH)
+        return await _fix_sql_query(sql_query, error_message, schema_info, question)
     except Exception as e:
-        return json.dumps({"error": f"LLM Error in validator_sql_agent: {e}"})
+        return {"error": f"LLM Error in validator_sql_agent: {e}"}
+
+# Recent query results, keyed by (sql_query, db_mtime_ns) and evicted least-recently-used.
+# Only results up to QUERY_CACHE_MAX_ROWS rows are kept, so a large SELECT * cannot pin
+# hundreds of MB in memory; bigger results are returned uncached.
+QUERY_CACHE_MAX_ENTRIES = 256
+QUERY_CACHE_MAX_ROWS = 10_000
+_QUERY_CACHE: "collections.OrderedDict[tuple, Tuple[Tuple[str, ...], Tuple[tuple, ...]]]" = collections.OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+
+def _execute_query(sql_query: str, db_mtime_ns: int) -> Tuple[Tuple[str, ...], Tuple[tuple, ...]]:
+    """
+    Runs sql_query on the shared connection and returns (column_names, rows).
+    Small results are memoized per query text; db_mtime_ns is part of the cache key so
+    a modified database never serves stale rows. Failed queries are not cached.
+    Cache misses still benefit from sqlite3's per-connection statement cache.
+    """
+    cache_key = (sql_query, db_mtime_ns)
+    with _QUERY_CACHE_LOCK:
+        if cache_key in _QUERY_CACHE:
+            _QUERY_CACHE.move_to_end(cache_key)
+            return _QUERY_CACHE[cache_key]
+
+    with _CONN_LOCK:
+        cursor = _get_connection().cursor()
+        try:
+            cursor.execute(sql_query)
+            results = tuple(cursor.fetchall())
+            column_names = tuple(desc[0] for desc in cursor.description)
+        finally:
+            cursor.close()
+
+    if len(results) <= QUERY_CACHE_MAX_ROWS:
+        with _QUERY_CACHE_LOCK:
+            _QUERY_CACHE[cache_key] = (column_names, results)
+            _QUERY_CACHE.move_to_end(cache_key)
+            while len(_QUERY_CACHE) > QUERY_CACHE_MAX_ENTRIES:
+                _QUERY_CACHE.popitem(last=False)
+    return column_names, results
 
 # --- Tool 4: Run SQLite Query---
 @mcp.tool()
-def run_sqlite_query(sql_dict: Dict) -> str:  #returns a JSON string
-    """Executes a SQL query and returns the data as a JSON string."""
+def run_sqlite_query(sql_dict: Dict) -> Dict[str, Any]: #returns a dict, sent as MCP structured content
+    """
+    Executes a SQL query and returns the data as a dict in columnar form:
+    {"columns": [column names], "rows": [[values], ...]}, so column names are stored once
+    rather than repeated in every row.
+    """
     try:
         #json_str = sql_json[sql_json.find('{') : sql_json.rfind('}') + 1]
         sql_query = sql_dict.get("sql_query")
@@ -248,81 +571,121 @@ def run_sqlite_query(sql_dict: Dict) -> str:  #returns a JSON string
         # if data.get("error"):
         #     return json.dumps({"error": f"Cannot execute due to previous error: {data['error']}", "data": []})
         if not sql_query:
-            return json.dumps({"error": "No SQL query provided.", "data": []})
-
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        results = cursor.fetchall()
-        column_names = [desc[0] for desc in cursor.description]
-        conn.close()
-
-        formatted_results = [dict(zip(column_names, row)) for row in results]
-        return json.dumps({"data": formatted_results})
-        # print(f"Query executed successfully. Results: {formatted_results}")
-        # return {"data": formatted_results}
+            return {"error": "No SQL query provided.", "columns": [], "rows": []}
+
+        try:
+            column_names, results = _execute_query(sql_query, os.stat(DB_PATH).st_mtime_ns)
+        except Exception:
+            _settle_pending_sql_cache(sql_query, succeeded=False)
+            raise
+        _settle_pending_sql_cache(sql_query, succeeded=True)
+
+        return {"columns": list(column_names), "rows": list(results)}
       
     except Exception as e:
-        return json.dumps({"error": f"Database query failed: {e}", "data": []})
+        return {"error": f"Database query failed: {e}", "columns": [], "rows": []}
 
 # --- Tool 5: Handle Error Agent (NEW) ---
 @mcp.tool()
-def handle_error_agent(failed_sql_query_dict: Dict, error_message: str) -> str: #returns a JSON string
+async def handle_error_agent(failed_sql_query_dict: Dict, error_message: str) -> Dict[str, Any]: #returns a dict, sent as MCP structured content
     """
     Attempts to fix a failed SQL query based on the specific error message from the database.
     """
     failed_sql_query = failed_sql_query_dict.get("sql_query", "Query not provided")
-    prompt = f"""
-    You are a highly skilled SQLite expert debugging a query.
-    
-    The following SQL query failed to execute:
-    ```sql
-    {failed_sql_query}
-    ```
-
-    It produced this specific error message:
-    `{error_message}`
-
-    Task:
-    1.  Carefully analyze the query and the error message.
-    2.  Provide a corrected SQLite query that resolves the identified error.
-    
-    Your output MUST be a single JSON object with one key: "sql_query", containing only the corrected query.
-    """
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022", max_tokens=1024, messages=[{"role": "user", "content": prompt}]
-        )
-        parsed_dict = _parse_llm_json_response(response.content[0].text)
-
-        return json.dumps(parsed_dict)
+        return await _fix_sql_query(failed_sql_query, error_message, get_database_schema(DB_PATH))
     except Exception as e:
-        return json.dumps({"error": f"LLM Error in handle_error_agent: {e}"})
+        return {"error": f"LLM Error in handle_error_agent: {e}"}
 
 # --- Tool 6: Generate Final Answer ---
 @mcp.tool()
-def generate_final_answer(question: str, query_result_dict: Dict) -> str:
+async def generate_final_answer(question: str, query_result_dict: Dict) -> str:
     """Takes the database results and generates a human-readable answer."""
-    query_result_json = json.dumps(query_result_dict, indent=2) 
+    query_result_json = orjson.dumps(query_result_dict).decode()
 
     prompt = f"""
     You are a helpful assistant. Answer the user's question based on the provided data.
     If the data contains an error, explain it simply. If the data is empty, say so.
+    The data is in columnar form: "columns" lists the column names once, and each entry in "rows"
+    is one row of values in the same order as "columns". If "truncated" is true, only the first rows are
+    included and "total_rows" gives the full number of rows returned by the query.
 
     Original Question: "{question}"
     Data from Database: {query_result_json}
     """
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-sonnet-20240229",
-            max_tokens=2048,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        print(f"Final Answer Result: {response.content[0].text}")
-        return response.content[0].text
+        final_answer = await _create_message("claude-3-sonnet-20240229", 2048, prompt)
+        print(f"Final Answer Result: {final_answer}")
+        return final_answer
     except Exception as e:
         return f"Error formulating final answer: {e}"
 
+# --- Tool 7: Get Schema ---
+@mcp.tool()
+def get_schema() -> str:
+    """
+    Returns the database schema description, so the client can fetch it ahead of validation.
+    Failures are raised (reported to MCP clients as an error result) so the error text is
+    never mistaken for a schema.
+    """
+    return get_database_schema(DB_PATH)
+
+# --- Tool 8: Get Data Dictionary ---
+@mcp.tool()
+def get_data_dictionary() -> str:
+    """Returns the formatted data dictionary description."""
+    return get_data_dictionary_description()
+
+# --- Tool 9: Combined NER + Create SQL + Validate ---
+@mcp.tool()
+async def ner_sql_validate_combined(question: str) -> Dict[str, Any]: #returns a dict, sent as MCP structured content
+    """
+    Does the work of ner_generator_dynamic, create_sql and validator_sql_agent in a
+    single LLM call: extracts entities, writes the SQLite query and validates it
+    against the schema. Returns a dict with "ner", "sql_query" and "validation_notes".
+    """
+    schema_info = get_database_schema(DB_PATH)
+    data_dictionary_info = get_data_dictionary_description()
+    system = f"""
+    You are an expert data analyst and an extremely meticulous SQLite developer. Answer the user's question by doing three steps in order.
+
+    Step 1 - Extract entities:
+    - "table": The table name(s), which are always county names (e.g., "King"). The user might mention multiple tables (counties).
+    - "columns_to_select": A list of columns the user wants to see.
+    - "filters": A dictionary of filters to apply, where the key is the column name and value is the condition.
+
+    Step 2 - Create a single, valid SQLite query that answers the question.
+    - The query may be complex, using window functions (like ROW_NUMBER(), PARTITION BY), subqueries, or other advanced features.
+    - The database has a separate table for each county (e.g., 'King', 'Thurston', 'Clark'), all with the exact same columns.
+    - If the question involves multiple tables (e.g., "in both Thurston and Clark"), you MUST use a JOIN or INTERSECT statement,
+      usually joining on a common column like "Make" or "VIN (1-10)".
+      Example: SELECT T1."Make" FROM Thurston AS T1 INNER JOIN Clark AS T2 ON T1."Make" = T2."Make";
+
+    Step 3 - Validate and correct the query:
+    1. Every column and table name in SELECT, WHERE, GROUP BY and ORDER BY must exactly match a name in the Official Schema.
+       Column names with spaces must be enclosed in double quotes (e.g., "Electric Range", "Base MSRP", "VIN (1-10)").
+    2. For categorical columns in the WHERE clause, use the full value from the Data Dictionary examples
+       (e.g., 'Battery Electric Vehicle (BEV)', not 'BEV').
+    3. Ensure the query logic reflects the question (e.g., "top 3" needs ORDER BY and LIMIT 3).
+
+    Your output MUST be a single JSON object with keys:
+    - "ner": the entities from Step 1, as an object with keys "table", "columns_to_select" and "filters".
+    - "sql_query": the final, validated and corrected SQLite query.
+    - "validation_notes": a short note on anything you corrected in Step 3.
+
+    *** Official Database Schema: ***
+    {schema_info}
+
+    *** Data Dictionary: *** (for column meanings and examples of values)
+    {data_dictionary_info}
+    """
+    prompt = f'User\'s Question: "{question}"'
+    try:
+        parsed_dict = await _create_structured_message("claude-3-5-sonnet-20241022", 2048, prompt, "emit_combined_result", _COMBINED_SCHEMA, system=system, cache_policy=CACHE_AFTER_SQL_RUNS)
+        return parsed_dict
+    except Exception as e:
+        return {"error": f"LLM Error in ner_sql_validate_combined: {e}"}
+
 # --- Run Server ---
 if __name__ == "__main__":
     print("MCP server with multi-step AI pipeline is starting...")
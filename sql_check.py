@@ -0,0 +1,100 @@
+import re
+from typing import Iterable, List, Tuple
+
+# Tokens of a SQLite query: comments, string literals, quoted identifiers, words,
+# and single punctuation characters. Whitespace is skipped.
+_TOKEN = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+    |(?P<string>'(?:[^']|'')*')
+    |(?P<quoted>"(?:[^"]|"")*")
+    |(?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+    |(?P<punct>\S)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Words after which a quoted name is an expression or table, never an alias.
+# END is left out on purpose: `CASE ... END "label"` is an alias.
+_KEYWORDS = frozenset("""
+    ALL AND AS ASC BETWEEN BY CASE CAST COLLATE CROSS DESC DISTINCT ELSE ESCAPE EXCEPT
+    EXISTS FILTER FROM GLOB GROUP HAVING IN INNER INTERSECT IS JOIN LEFT LIKE LIMIT MATCH
+    NATURAL NOT NULLS OFFSET ON OR ORDER OUTER OVER PARTITION RANGE RECURSIVE REGEXP RIGHT
+    ROWS SELECT THEN UNION USING VALUES WHEN WHERE WINDOW WITH
+""".split())
+
+def _tokenize(sql_query: str) -> List[Tuple[str, str]]:
+    tokens = []
+    for match in _TOKEN.finditer(sql_query):
+        kind = match.lastgroup
+        if kind != "comment":
+            tokens.append((kind, match.group()))
+    return tokens
+
+def _unquote(token: str) -> str:
+    return token[1:-1].replace('""', '"')
+
+def _is_word(token: Tuple[str, str], word: str) -> bool:
+    return token[0] == "word" and token[1].upper() == word
+
+def _ends_expression(token: Tuple[str, str]) -> bool:
+    """True if a quoted name right after this token would be an alias without AS."""
+    kind, value = token
+    if kind in ("quoted", "string", "number"):
+        return True
+    if kind == "punct":
+        return value == ")"
+    return value.upper() not in _KEYWORDS
+
+def _defined_names(tokens: List[Tuple[str, str]]) -> set:
+    """Lower-cased names the query defines itself: aliases, CTE names and CTE column lists."""
+    defined = set()
+    for i, (kind, value) in enumerate(tokens):
+        if kind != "quoted":
+            continue
+        name = _unquote(value).lower()
+        # `... AS "alias"` and `"cte" AS (`
+        if i > 0 and _is_word(tokens[i - 1], "AS"):
+            defined.add(name)
+        # Alias without AS: `COUNT(*) "n"`, `(SELECT ...) "sub"`, `King "k"`
+        elif i > 0 and _ends_expression(tokens[i - 1]):
+            defined.add(name)
+        if i + 2 < len(tokens) and _is_word(tokens[i + 1], "AS") and tokens[i + 2][1] == "(":
+            defined.add(name)
+
+    # CTE column lists: `name("a", "b") AS (`
+    for i, (kind, value) in enumerate(tokens):
+        if value != "(" or i == 0 or tokens[i - 1][0] not in ("quoted", "word"):
+            continue
+        j = i + 1
+        columns = []
+        while j < len(tokens) and tokens[j][0] in ("quoted", "word", "punct") and tokens[j][1] != ")":
+            if tokens[j][0] == "quoted":
+                columns.append(_unquote(tokens[j][1]).lower())
+            elif tokens[j][0] == "punct" and tokens[j][1] != ",":
+                break
+            j += 1
+        if j + 2 < len(tokens) and tokens[j][1] == ")" and _is_word(tokens[j + 1], "AS") and tokens[j + 2][1] == "(":
+            defined.update(columns)
+            if tokens[i - 1][0] == "quoted":
+                defined.add(_unquote(tokens[i - 1][1]).lower())
+    return defined
+
+def find_unknown_identifiers(sql_query: str, known_identifiers: Iterable[str]) -> List[str]:
+    """
+    Returns the double-quoted names in sql_query that are neither in known_identifiers
+    (lower-cased table and column names) nor an alias, CTE name or CTE column the query
+    defines itself. SQLite silently treats an unknown double-quoted name as a string
+    literal, so EXPLAIN alone does not reject them.
+    """
+    tokens = _tokenize(sql_query)
+    known = set(known_identifiers) | _defined_names(tokens)
+
+    unknown = []
+    for kind, value in tokens:
+        if kind == "quoted":
+            name = _unquote(value)
+            if name.lower() not in known and name not in unknown:
+                unknown.append(name)
+    return unknown
@@ -0,0 +1,52 @@
+from sql_check import find_unknown_identifiers
+
+KNOWN = {"king", "clark", "make", "city", "electric range", "base msrp", "electric vehicle type"}
+
+def test_unknown_quoted_column_is_reported():
+    assert find_unknown_identifiers('SELECT MAX("Electric_Range") FROM King', KNOWN) == ["Electric_Range"]
+
+def test_unknown_quoted_column_in_where_is_reported():
+    assert find_unknown_identifiers("SELECT * FROM King WHERE \"Fuel Type\" = 'BEV'", KNOWN) == ["Fuel Type"]
+
+def test_known_names_are_case_insensitive():
+    assert find_unknown_identifiers('SELECT "MAKE", "Electric Range" FROM "king"', KNOWN) == []
+
+def test_double_quotes_inside_string_literals_are_ignored():
+    assert find_unknown_identifiers("SELECT \"Make\" FROM King WHERE \"City\" = 'say \"hi\"'", KNOWN) == []
+
+def test_alias_with_as():
+    assert find_unknown_identifiers('SELECT COUNT(*) AS "n" FROM King ORDER BY "n"', KNOWN) == []
+
+def test_alias_without_as():
+    assert find_unknown_identifiers('SELECT COUNT(*) "n" FROM King ORDER BY "n" DESC', KNOWN) == []
+
+def test_column_alias_without_as():
+    assert find_unknown_identifiers('SELECT "Make" "m" FROM King', KNOWN) == []
+
+def test_case_expression_alias_without_as():
+    assert find_unknown_identifiers("SELECT CASE WHEN \"Make\" = 'X' THEN 1 ELSE 0 END \"is_x\" FROM King", KNOWN) == []
+
+def test_subquery_alias_without_as():
+    query = 'SELECT "sub"."Make" FROM (SELECT "Make" FROM King) "sub"'
+    assert find_unknown_identifiers(query, KNOWN) == []
+
+def test_table_alias_without_as():
+    query = 'SELECT "k"."Make" FROM King "k" JOIN Clark "c" ON "k"."Make" = "c"."Make"'
+    assert find_unknown_identifiers(query, KNOWN) == []
+
+def test_cte_name_and_column_list():
+    query = 'WITH "r"("m", "c") AS (SELECT "Make", COUNT(*) FROM King GROUP BY "Make") SELECT "m", "c" FROM "r"'
+    assert find_unknown_identifiers(query, KNOWN) == []
+
+def test_unquoted_cte_name_with_column_list():
+    query = 'WITH r("m") AS (SELECT "Make" FROM King) SELECT "m" FROM r'
+    assert find_unknown_identifiers(query, KNOWN) == []
+
+def test_function_argument_is_not_an_alias():
+    assert find_unknown_identifiers('SELECT COUNT("Bogus") FROM King', KNOWN) == ["Bogus"]
+
+def test_qualified_unknown_column_is_reported():
+    assert find_unknown_identifiers('SELECT T1."Bogus" FROM King AS T1', KNOWN) == ["Bogus"]
+
+def test_trailing_comment_is_ignored():
+    assert find_unknown_identifiers('SELECT "Make" FROM King -- "not a column"', KNOWN) == []